@@ -1,13 +1,12 @@
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from pymongo import MongoClient
 from dotenv import load_dotenv, find_dotenv
 from flask_bcrypt import Bcrypt
 from openai import OpenAI
-from bson.objectid import ObjectId
 import os
 import json
 from datetime import datetime
-from db_service import DBService
+from db_service import DBService, get_mongo_client
+from schedule_utils import PH_TZ
 from planner_engine import PlannerEngine
 #ced updated
 # Load .env file
@@ -24,8 +23,8 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 bcrypt = Bcrypt(app)
 app.secret_key = SECRET_KEY
 
-# Connect to MongoDB
-client = MongoClient(MONGO_URI)
+# Connect to MongoDB (shared, pooled client)
+client = get_mongo_client(MONGO_URI)
 db = client["SmartSchedule"]
 users_collection = db["users"]
 
@@ -268,6 +267,10 @@ function_map = {
 }
 
 
+# save_* tools queued during a chat turn and written together via add_schedule_items_bulk
+batched_save_types = {"save_class": "class", "save_task": "task", "save_test": "test"}
+
+
 # ---------------------------------------------------------------
 
 # ---------- AUTH ROUTES (Updated User Initialization) ----------
@@ -302,10 +305,9 @@ def login():
         if user and bcrypt.check_password_hash(user["password"], password):
             session["username"] = username
             session["user_id"] = str(user["_id"])
-            users_collection.update_one(
-                {"username": username},
-                {"$set": {"chat_history": []}}
-            )
+            db_service.update_chat_history(session["user_id"], [])
+            # Prune past tasks/tests/plan blocks once per login rather than on every dashboard load
+            db_service.auto_cleanup_past_items(session["user_id"], datetime.now(PH_TZ))
             return redirect(url_for("index"))
         return "Invalid credentials!"
     return render_template("login.html")
@@ -315,10 +317,7 @@ def login():
 def logout():
     if "username" in session:
         if "user_id" in session:
-            db_service.users_collection.update_one(
-                {"_id": ObjectId(session["user_id"])},
-                {"$set": {"chat_history": []}}
-            )
+            db_service.update_chat_history(session["user_id"], [])
         session.pop("username", None)
         session.pop("user_id", None)
     return redirect(url_for("login"))
@@ -348,7 +347,7 @@ def chat():
     # === LOCK CHECK ===
     # If the user has already finalized their setup, we reject further chat interactions
     # and instruct the frontend to switch to Dashboard mode.
-    user_data_full = db_service.get_user_data(user_id)
+    user_data_full = db_service.get_user_data(user_id, {"setup_complete": 1, "chat_history": 1})
     if user_data_full.get("setup_complete", False):
         return jsonify({
             "reply": "Setup is complete. The AI is now disabled. Please use the manual controls to edit your schedule.",
@@ -425,6 +424,7 @@ def chat():
         run_planner = False
         planner_response = None
         action_flag = None
+        pending_items = []
 
         if response_message.tool_calls:
             for tool_call in response_message.tool_calls:
@@ -433,6 +433,11 @@ def chat():
 
                 func = function_map.get(function_name)
 
+                # Later tools may depend on queued saves (e.g. recurring blocks look up the task)
+                if pending_items and function_name not in batched_save_types:
+                    db_service.add_schedule_items_bulk(user_id, pending_items)
+                    pending_items = []
+
                 if not func:
                     response_msg_for_user = "Error: AI tried to call an unknown function."
 
@@ -459,12 +464,20 @@ def chat():
                     else:
                         response_msg_for_user = planner_response.get("message")
 
+                elif function_name in batched_save_types:
+                    # Queued and written in one round-trip with any other saves from this turn
+                    pending_items.append((batched_save_types[function_name], arguments))
+                    response_msg_for_user = map_db_update_response(function_name, True, arguments)
+
+                    if function_name != "save_class":
+                        run_planner = True
+
                 else:
-                    # Generic DB persistence calls (e.g., save_task)
+                    # Generic DB persistence calls (e.g., save_preference)
                     db_result = func(user_id, arguments)
                     response_msg_for_user = map_db_update_response(function_name, db_result, arguments)
 
-                    if function_name in ["save_task", "save_test", "update_task_details", "delete_schedule_item"]:
+                    if function_name in ["update_task_details", "delete_schedule_item"]:
                         run_planner = True  # For tasks/tests changes, we still trigger the planner
 
                 messages.append({
@@ -475,6 +488,9 @@ def chat():
                 })
                 reply_to_send = response_msg_for_user
 
+            if pending_items:
+                db_service.add_schedule_items_bulk(user_id, pending_items)
+
         else:
             reply_to_send = response_message.content
 
@@ -485,7 +501,7 @@ def chat():
                 # If fallback runs and succeeds, we still use the detailed message here
                 reply_to_send += f" (Note: {planner_response['message']})"
 
-        db_service.users_collection.update_one({"_id": ObjectId(user_id)}, {"$set": {"chat_history": messages}})
+        db_service.update_chat_history(user_id, messages)
 
         # Construct JSON response
         response_payload = {"reply": reply_to_send}
@@ -510,9 +526,8 @@ def get_schedule():
     client_now = datetime.fromisoformat(
         client_timestamp_str.replace("Z", "+00:00")) if client_timestamp_str else datetime.now()
 
-    db_service.auto_cleanup_past_items(user_id, client_now)
-
-    user_data = db_service.get_user_data(user_id)
+    # Past items are filtered out at read time; physical cleanup happens on login
+    user_data = db_service.get_schedule_data(user_id, client_now)
 
     if not user_data:
         return jsonify({"error": "User not found"}), 404
@@ -1,6 +1,24 @@
 from pymongo import MongoClient
 from bson.objectid import ObjectId
-from datetime import datetime, time, timedelta, timezone
+from datetime import timedelta
+from functools import lru_cache
+import re
+from schedule_utils import PH_TZ, time_to_minutes
+
+
+@lru_cache()
+def get_mongo_client(mongo_uri):
+    """
+    Returns a process-wide MongoClient for the URI.
+    Reusing one pooled client avoids repeating the TCP/TLS/auth handshake per DBService.
+    """
+    return MongoClient(
+        mongo_uri,
+        maxPoolSize=50,
+        minPoolSize=5,
+        socketTimeoutMS=20000,
+        connectTimeoutMS=10000
+    )
 
 
 class DBService:
@@ -15,59 +33,113 @@ class DBService:
         self.users_collection = self.db["users"]
 
     # --- INTERNAL HELPER ---
-    def _parse_deadline_to_aware(self, item):
-        """Helper to convert task/test deadline strings to timezone-aware datetime objects."""
-        deadline_str = item.get("deadline", item.get("date"))
-        if not deadline_str: return None
-        if 'T' not in deadline_str:
-            deadline_str += "T23:59:59"
-
-        try:
-            dt = datetime.fromisoformat(deadline_str)
-            if dt.tzinfo is None:
-                dt = dt.replace(tzinfo=timezone.utc)
-            return dt
-        except ValueError:
-            return None
+    def _deadline_iso(self, dt):
+        """
+        Formats dt the way deadlines are stored: naive ISO in PH time, which is how the planner
+        reads them. Every 'not yet past' comparison goes through this so all views agree.
+        """
+        return dt.astimezone(PH_TZ).strftime("%Y-%m-%dT%H:%M:%S")
+
+    def _filter_array(self, array_name, cond):
+        """Builds a $filter expression over one of the user's arrays (missing arrays become [])."""
+        return {
+            "$filter": {
+                "input": {"$ifNull": [f"${array_name}", []]},
+                "as": "item",
+                "cond": cond
+            }
+        }
+
+    def _active_items_filter(self, array_name, now_iso, cutoff_iso):
+        """
+        Keeps items that are not yet past and are due before the cutoff (or marked 'top').
+        Deadlines are stored as zero-padded ISO strings, so string comparison follows date order.
+        """
+        return self._filter_array(array_name, {
+            "$and": [
+                {"$eq": [{"$type": "$$item.deadline"}, "string"]},
+                {"$gte": ["$$item.deadline", now_iso]},
+                {"$or": [
+                    {"$lt": ["$$item.deadline", cutoff_iso]},
+                    {"$eq": ["$$item.priority", "top"]}
+                ]}
+            ]
+        })
+
+    def _plan_blocks_for(self, item_name, prefix=""):
+        """
+        Matches plan blocks belonging to an item: exactly via task_name, falling back to the
+        display text for blocks saved before task_name was stored. The fallback is an anchored,
+        escaped, case-sensitive regex so it behaves as a literal comparison.
+        """
+        legacy_task = {"$regex": f"^Work on {re.escape(item_name)}$"}
+        return {"$or": [
+            {f"{prefix}task_name": item_name},
+            {f"{prefix}task_name": {"$exists": False}, f"{prefix}task": legacy_task}
+        ]}
 
     # --- READ OPERATIONS ---
 
     def get_active_context_data(self, user_id, now_dt):
         """
-        Fetches user data, pruning tasks/tests.
+        Fetches user data, pruning tasks/tests server-side via an aggregation pipeline.
         """
-        user_data = self.get_user_data(user_id)
+        now_iso = self._deadline_iso(now_dt)
+        cutoff_iso = self._deadline_iso(now_dt + timedelta(days=30))
+
+        pipeline = [
+            {"$match": {"_id": ObjectId(user_id)}},
+            {"$project": {
+                "_id": 0,
+                "schedule": 1,
+                "preferences": 1,
+                "tasks": self._active_items_filter("tasks", now_iso, cutoff_iso),
+                "tests": self._active_items_filter("tests", now_iso, cutoff_iso),
+            }},
+            # Internal precomputed fields are not useful to the model; keep them out of the prompt
+            {"$project": {
+                "schedule.start_min": 0,
+                "schedule.end_min": 0,
+            }}
+        ]
+        user_data = next(self.users_collection.aggregate(pipeline), None)
         if not user_data:
             return None
 
-        cutoff_dt = now_dt + timedelta(days=30)
-
-        active_tasks = []
-        for task in user_data.get("tasks", []):
-            deadline = self._parse_deadline_to_aware(task)
-            priority = task.get("priority")
-            if deadline and (deadline < cutoff_dt or priority == "top"):
-                active_tasks.append(task)
-
-        active_tests = []
-        for test in user_data.get("tests", []):
-            deadline = self._parse_deadline_to_aware(test)
-            priority = test.get("priority")
-            if deadline and (deadline < cutoff_dt or priority == "top"):
-                active_tests.append(test)
-
         pruned_context = {
             "schedule": user_data.get("schedule", []),
-            "tasks": active_tasks,
-            "tests": active_tests,
+            "tasks": user_data.get("tasks", []),
+            "tests": user_data.get("tests", []),
             "preferences": user_data.get("preferences", {}),
         }
 
         return pruned_context
 
-    def get_user_data(self, user_id):
-        """Fetches all user data by ObjectId."""
-        return self.users_collection.find_one({"_id": ObjectId(user_id)})
+    def get_schedule_data(self, user_id, now_dt):
+        """
+        Fetches the dashboard view, hiding past tasks, tests, and plan blocks at read time.
+        Physical pruning is left to auto_cleanup_past_items, which is no longer on the request path.
+        """
+        now_iso = self._deadline_iso(now_dt)
+        today_date_str = now_iso[:10]
+
+        pipeline = [
+            {"$match": {"_id": ObjectId(user_id)}},
+            {"$project": {
+                "_id": 0,
+                "schedule": 1,
+                "preferences": 1,
+                "setup_complete": 1,
+                "tasks": self._filter_array("tasks", {"$gte": ["$$item.deadline", now_iso]}),
+                "tests": self._filter_array("tests", {"$gte": ["$$item.date", today_date_str]}),
+                "generated_plan": self._filter_array("generated_plan", {"$gte": ["$$item.date", today_date_str]}),
+            }}
+        ]
+        return next(self.users_collection.aggregate(pipeline), None)
+
+    def get_user_data(self, user_id, projection=None):
+        """Fetches user data by ObjectId, limited to the projected fields when given."""
+        return self.users_collection.find_one({"_id": ObjectId(user_id)}, projection)
 
     # --- WRITE OPERATIONS ---
 
@@ -87,17 +159,28 @@ class DBService:
         )
         return result.modified_count > 0
 
-    def add_schedule_item(self, user_id, data_type, data):
-        """Adds a class, task, or test to the user's document."""
+    def _prepare_schedule_item(self, data_type, data):
+        """Normalizes a class, task, or test in place and returns the array it belongs to."""
         if data_type == "class":
+            # Precompute minutes since midnight so conflict checks skip the string parse
+            if data.get('start_time'): data['start_min'] = time_to_minutes(data['start_time'])
+            if data.get('end_time'): data['end_min'] = time_to_minutes(data['end_time'])
             update_field = "schedule"
         elif data_type == "task":
+            # Store a canonical full ISO deadline so readers never have to patch it up
+            if data.get('deadline') and 'T' not in data['deadline']:
+                data['deadline'] += "T23:59:59"
             update_field = "tasks"
         elif data_type == "test":
             data['deadline'] = f"{data['date']}T23:59:59"
             update_field = "tests"
         else:
             raise ValueError("Invalid data_type provided.")
+        return update_field
+
+    def add_schedule_item(self, user_id, data_type, data):
+        """Adds a class, task, or test to the user's document."""
+        update_field = self._prepare_schedule_item(data_type, data)
 
         result = self.users_collection.update_one(
             {"_id": ObjectId(user_id)},
@@ -105,41 +188,61 @@ class DBService:
         )
         return result.modified_count > 0
 
+    def add_schedule_items_bulk(self, user_id, items):
+        """Adds several (data_type, data) items with a single $push/$each update."""
+        pushes = {}
+        for data_type, data in items:
+            update_field = self._prepare_schedule_item(data_type, data)
+            pushes.setdefault(update_field, []).append(data)
+
+        if not pushes: return False
+
+        result = self.users_collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$push": {field: {"$each": values} for field, values in pushes.items()}}
+        )
+        return result.modified_count > 0
+
     def update_task_details(self, user_id, args):
-        """Updates an existing task or test details."""
+        """
+        Updates an existing task or test details.
+        The tasks/tests lookup and the plan rename run as a single update via arrayFilters,
+        so every task/test carrying current_name is updated (not just the first match).
+        Returns 0 if no item has that name, -1 if nothing to update was given.
+        """
         current_name = args.get("current_name")
         updates = {}
-        target_array = None
 
-        if self.users_collection.find_one({"_id": ObjectId(user_id), "tasks.name": current_name}):
-            target_array = "tasks"
-        elif self.users_collection.find_one({"_id": ObjectId(user_id), "tests.name": current_name}):
-            target_array = "tests"
-
-        if not target_array: return 0
+        # 't' matches the item in tasks, 's' the item in tests (type fields differ per array)
+        for array_name, marker, type_field in (("tasks", "t", "task_type"), ("tests", "s", "test_type")):
+            prefix = f"{array_name}.$[{marker}]"
+            if args.get("new_name"): updates[f"{prefix}.name"] = args["new_name"]
+            if args.get("new_task_type"): updates[f"{prefix}.{type_field}"] = args["new_task_type"]
+            if args.get("new_deadline"): updates[f"{prefix}.deadline"] = args["new_deadline"]
+            if args.get("new_priority"): updates[f"{prefix}.priority"] = args["new_priority"]
+            if args.get("new_duration_hours") is not None: updates[f"{prefix}.duration_hours"] = args[
+                "new_duration_hours"]
+
+        if not updates:
+            # Preserve "not found" over "nothing to update"; only this no-op path pays for the probe
+            exists = self.users_collection.find_one(
+                {"_id": ObjectId(user_id), "$or": [{"tasks.name": current_name}, {"tests.name": current_name}]},
+                {"_id": 1}
+            )
+            return -1 if exists else 0
 
-        if args.get("new_name"): updates[f"{target_array}.$.name"] = args["new_name"]
-        if args.get("new_task_type"):
-            type_field = "test_type" if target_array == "tests" else "task_type"
-            updates[f"{target_array}.$.{type_field}"] = args["new_task_type"]
-        if args.get("new_deadline"): updates[f"{target_array}.$.deadline"] = args["new_deadline"]
-        if args.get("new_priority"): updates[f"{target_array}.$.priority"] = args["new_priority"]
-        if args.get("new_duration_hours") is not None: updates[f"{target_array}.$.duration_hours"] = args[
-            "new_duration_hours"]
+        array_filters = [{"t.name": current_name}, {"s.name": current_name}]
 
-        if not updates: return -1
+        if args.get("new_name"):
+            updates["generated_plan.$[elem].task"] = f"Work on {args['new_name']}"
+            updates["generated_plan.$[elem].task_name"] = args["new_name"]
+            array_filters.append(self._plan_blocks_for(current_name, prefix="elem."))
 
         result = self.users_collection.update_one(
-            {"_id": ObjectId(user_id), f"{target_array}.name": current_name},
-            {"$set": updates}
+            {"_id": ObjectId(user_id), "$or": [{"tasks.name": current_name}, {"tests.name": current_name}]},
+            {"$set": updates},
+            array_filters=array_filters
         )
-
-        if args.get("new_name") and result.modified_count > 0:
-            self.users_collection.update_one(
-                {"_id": ObjectId(user_id)},
-                {"$set": {"generated_plan.$[elem].task": f"Work on {args['new_name']}"}},
-                array_filters=[{"elem.task": {"$regex": current_name, "$options": "i"}}]
-            )
         return result.modified_count
 
     def update_class_schedule(self, user_id, args):
@@ -147,8 +250,12 @@ class DBService:
         subject = args.get("subject")
         updates = {}
         if "new_day" in args: updates["schedule.$.day"] = args["new_day"]
-        if "new_start_time" in args: updates["schedule.$.start_time"] = args["new_start_time"]
-        if "new_end_time" in args: updates["schedule.$.end_time"] = args["new_end_time"]
+        if "new_start_time" in args:
+            updates["schedule.$.start_time"] = args["new_start_time"]
+            updates["schedule.$.start_min"] = time_to_minutes(args["new_start_time"])
+        if "new_end_time" in args:
+            updates["schedule.$.end_time"] = args["new_end_time"]
+            updates["schedule.$.end_min"] = time_to_minutes(args["new_end_time"])
 
         if not updates: return -1
 
@@ -159,18 +266,19 @@ class DBService:
         return result.modified_count
 
     def delete_schedule_item(self, user_id, item_name):
-        """Deletes an item and related plan blocks."""
-        result_class = self.users_collection.update_one({"_id": ObjectId(user_id)},
-                                                        {"$pull": {"schedule": {"subject": item_name}}})
-        result_task = self.users_collection.update_one({"_id": ObjectId(user_id)},
-                                                       {"$pull": {"tasks": {"name": item_name}}})
-        result_test = self.users_collection.update_one({"_id": ObjectId(user_id)},
-                                                       {"$pull": {"tests": {"name": item_name}}})
-        result_plan = self.users_collection.update_one({"_id": ObjectId(user_id)}, {
-            "$pull": {"generated_plan": {"task": {"$regex": item_name, "$options": "i"}}}})
-
-        return (result_class.modified_count > 0 or result_task.modified_count > 0 or
-                result_test.modified_count > 0 or result_plan.modified_count > 0)
+        """Deletes an item and related plan blocks in a single update."""
+        result = self.users_collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {
+                "$pull": {
+                    "schedule": {"subject": item_name},
+                    "tasks": {"name": item_name},
+                    "tests": {"name": item_name},
+                    "generated_plan": self._plan_blocks_for(item_name)
+                }
+            }
+        )
+        return result.modified_count > 0
 
     def update_generated_plan(self, user_id, new_plan):
         """Saves the result of the planning engine."""
@@ -181,9 +289,9 @@ class DBService:
         return result.modified_count > 0
 
     def auto_cleanup_past_items(self, user_id, now_dt):
-        """Removes past tasks, tests, and plan blocks based on client time."""
-        now_iso = now_dt.isoformat()
-        today_date_str = now_dt.strftime("%Y-%m-%d")
+        """Removes past tasks, tests, and plan blocks (same cutoffs as get_schedule_data)."""
+        now_iso = self._deadline_iso(now_dt)
+        today_date_str = now_iso[:10]
 
         self.users_collection.update_one(
             {"_id": ObjectId(user_id)},
@@ -196,6 +304,14 @@ class DBService:
             }
         )
 
+    def update_chat_history(self, user_id, messages):
+        """Replaces the stored chat history."""
+        result = self.users_collection.update_one(
+            {"_id": ObjectId(user_id)},
+            {"$set": {"chat_history": messages}}
+        )
+        return result.modified_count > 0
+
     # --- MANUAL DELETE & MARK DONE ---
 
     def delete_single_block(self, user_id, task_name, date_str, start_time):
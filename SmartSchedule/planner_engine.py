@@ -1,9 +1,11 @@
-from datetime import datetime, timedelta, time, timezone
+from datetime import datetime, timedelta, time
+from collections import defaultdict
 import calendar
+from schedule_utils import (
+    PH_TZ, time_to_minutes, parse_iso_cached, parse_deadline_fast
+)
 
 # --- CONSTANTS ---
-PH_TZ = timezone(timedelta(hours=8))  # >>> Philippines timezone <<<
-
 DEFAULT_PRIORITY_MAP = {
     "top": 0, "high": 1, "medium": 2, "low": 3,
     "exam": 1, "project": 5, "quiz": 3, "assignment": 4, "seatwork": 5
@@ -35,15 +37,6 @@ INFINITE_BLOCKS = 999
 
 
 # --- HELPER FUNCTIONS ---
-def _time_to_minutes(time_str):
-    """Converts HH:MM string to minutes since midnight."""
-    try:
-        t = time.fromisoformat(time_str)
-        return t.hour * 60 + t.minute
-    except ValueError:
-        return 0
-
-
 def _format_time_12hr(time_str):
     """Converts an 'HH:MM' string to 'H:MM AM/PM'."""
     if not time_str or ':' not in time_str:
@@ -78,7 +71,8 @@ class PlannerEngine:
         start_time = args.get("start_time")
         end_time = args.get("end_time")
 
-        user_data = self.db_service.get_user_data(user_id)
+        user_data = self.db_service.get_user_data(
+            user_id, {"tasks": 1, "tests": 1, "schedule": 1, "generated_plan": 1})
         all_items = user_data.get("tasks", []) + user_data.get("tests", [])
 
         target_item = next((item for item in all_items if item.get("name").lower() == item_name.lower()), None)
@@ -89,10 +83,7 @@ class PlannerEngine:
 
         # Parse the deadline string into a datetime object for internal use
         try:
-            deadline_str = target_item['deadline']
-            if len(deadline_str.split('T')) == 1:
-                deadline_str += 'T23:59:59'
-            target_item['deadline_dt'] = datetime.fromisoformat(deadline_str).replace(tzinfo=PH_TZ)
+            target_item['deadline_dt'] = parse_iso_cached(target_item['deadline'])
         except Exception as e:
             return {"status": "error", "message": "Internal Error: Could not parse task deadline."}
 
@@ -135,85 +126,111 @@ class PlannerEngine:
         item_type = target_item.get("task_type", target_item.get("test_type", "default"))
         ideal_session_size = SESSION_IDEAL_DURATION_MAP.get(item_type, 1.0)  # Float default
 
-        classes = user_data.get("schedule", [])
-        target_day_indices = [DAY_MAP_TO_INDEX.get(d) for d in days if d in DAY_MAP_TO_INDEX]
-
-        requested_start_min = _time_to_minutes(start_time)
-        requested_end_min = _time_to_minutes(end_time)
-
-        # Loop stops *before* the deadline day begins (midnight)
-        stop_date = datetime.combine(deadline_dt.date(), time(0), tzinfo=PH_TZ)
-
-        # Start iterating from today's date
-        while datetime.combine(current_day, time(0), tzinfo=PH_TZ) < stop_date:
-
-            if current_day.weekday() in target_day_indices:
+        # Group classes by day once instead of rescanning the whole schedule for every date
+        classes_by_day = defaultdict(list)
+        for cls in user_data.get("schedule", []):
+            classes_by_day[cls.get('day')].append(cls)
 
-                # Setup proposed block times (PH_TZ aware)
-                block_start_time_naive = time.fromisoformat(start_time)
-                block_end_time_naive = time.fromisoformat(end_time)
-
-                block_start_dt = datetime.combine(current_day, block_start_time_naive, tzinfo=PH_TZ)
-                block_end_dt = datetime.combine(current_day, block_end_time_naive, tzinfo=PH_TZ)
-
-                # 1. PAST TIME CHECK (If scheduling for today)
-                if current_day == now_dt.date() and block_end_dt < now_dt.astimezone(PH_TZ):
-                    messages.append(
-                        f"Skipping {DAY_OF_WEEK_MAP[current_day.weekday()]} block: Time slot has passed today.")
-                    current_day += timedelta(days=1)
-                    continue
-
-                # 2. CLASS CONFLICT CHECK
-                is_conflict, conflicting_subject = self._check_class_conflict(current_day, requested_start_min,
-                                                                              requested_end_min, classes)
-
-                if is_conflict:
-                    messages.append(
-                        f"Skipping {current_day.strftime('%b %d')} block: Conflict with class '{conflicting_subject}'.")
-                    current_day += timedelta(days=1)
-                    continue
-
-                # 3. SESSION CAP CHECK (Updated for Floats)
-                duration_hours = (block_end_dt - block_start_dt).total_seconds() / 3600.0
-
-                # We prioritize the User's requested window, but warn if it exceeds ideal size for that type
-                # (Logic adjusted: We only cap if it's significantly larger, otherwise trust user input for recurring blocks)
-                allocated_hours = min(duration_hours, ideal_session_size)
-
-                # If the user asks for 2 hours for a 'seatwork' (ideal 0.5), we cap it.
-                final_end_dt = block_start_dt + timedelta(hours=allocated_hours)
-
-                if allocated_hours < duration_hours:
-                    messages.append(
-                        f"Note: Block on {current_day.strftime('%b %d')} capped at {allocated_hours} hr(s) due to {item_type} limits.")
-
-                # 4. Add to Plan
-                generated_blocks.append({
-                    "date": current_day.strftime("%Y-%m-%d"),
-                    "start_time": block_start_dt.strftime("%H:%M"),
-                    "end_time": final_end_dt.strftime("%H:%M"),
-                    "task": f"Work on {target_item['name']}",
-                    "completed": False  # Default to not done
-                })
-
-            current_day += timedelta(days=1)
+        target_day_indices = [DAY_MAP_TO_INDEX.get(d) for d in days if d in DAY_MAP_TO_INDEX]
+        if not target_day_indices:
+            return generated_blocks, messages
+
+        # Jump table: days from each weekday to the next requested weekday, so the loop
+        # only ever visits days that can receive a block instead of scanning every date
+        days_to_next_block = [1 + min((t - wd - 1) % 7 for t in target_day_indices) for wd in range(7)]
+        next_block_step = [timedelta(days=n) for n in days_to_next_block]
+
+        # Block times are the same every day, so work in integer minutes and format them once
+        block_start_time_naive = time.fromisoformat(start_time)
+        block_end_time_naive = time.fromisoformat(end_time)
+        requested_start_min = block_start_time_naive.hour * 60 + block_start_time_naive.minute
+        requested_end_min = block_end_time_naive.hour * 60 + block_end_time_naive.minute
+
+        today = now_dt.date()
+        now_ph = now_dt.astimezone(PH_TZ)
+
+        # SESSION CAP CHECK (applied to every block below, in integer minutes)
+        duration_min = requested_end_min - requested_start_min
+
+        # We prioritize the User's requested window, but warn if it exceeds ideal size for that type
+        # (Logic adjusted: We only cap if it's significantly larger, otherwise trust user input for recurring blocks)
+        alloc_min = min(duration_min, round(ideal_session_size * 60))
+        allocated_hours = alloc_min / 60.0  # Only used for the cap message
+
+        # If the user asks for 2 hours for a 'seatwork' (ideal 0.5), we cap it.
+        final_end_min = (requested_start_min + alloc_min) % (24 * 60)
+
+        block_start_str = f"{requested_start_min // 60:02d}:{requested_start_min % 60:02d}"
+        block_end_str = f"{final_end_min // 60:02d}:{final_end_min % 60:02d}"
+
+        # Loop stops *before* the deadline day begins (plain date comparison, no per-day datetime)
+        stop_date = deadline_dt.date()
+
+        # Classes repeat weekly, so the conflict result only depends on the weekday
+        conflict_by_weekday = {}
+        task_name = target_item['name']
+        task_label = f"Work on {task_name}"
+
+        # Start iterating from the first requested weekday on or after today
+        current_day += timedelta(days=min((t - current_day.weekday()) % 7 for t in target_day_indices))
+        while current_day < stop_date:
+
+            # 1. PAST TIME CHECK (If scheduling for today)
+            if current_day == today and datetime.combine(current_day, block_end_time_naive, tzinfo=PH_TZ) < now_ph:
+                messages.append(
+                    f"Skipping {DAY_OF_WEEK_MAP[current_day.weekday()]} block: Time slot has passed today.")
+                current_day += next_block_step[current_day.weekday()]
+                continue
+
+            # 2. CLASS CONFLICT CHECK (computed once per weekday)
+            weekday = current_day.weekday()
+            if weekday not in conflict_by_weekday:
+                conflict_by_weekday[weekday] = self._check_class_conflict(current_day, requested_start_min,
+                                                                          requested_end_min, classes_by_day)
+            is_conflict, conflicting_subject = conflict_by_weekday[weekday]
+
+            if is_conflict:
+                messages.append(
+                    f"Skipping {current_day.strftime('%b %d')} block: Conflict with class '{conflicting_subject}'.")
+                current_day += next_block_step[current_day.weekday()]
+                continue
+
+            # 3. SESSION CAP NOTE
+            if alloc_min < duration_min:
+                messages.append(
+                    f"Note: Block on {current_day.strftime('%b %d')} capped at {allocated_hours} hr(s) due to {item_type} limits.")
+
+            # 4. Add to Plan
+            generated_blocks.append({
+                "date": current_day.strftime("%Y-%m-%d"),
+                "start_time": block_start_str,
+                "end_time": block_end_str,
+                "task": task_label,
+                "task_name": task_name,  # Exact reference used for renames/deletes
+                "completed": False  # Default to not done
+            })
+
+            current_day += next_block_step[current_day.weekday()]
 
         return generated_blocks, messages
 
     # --- CONFLICT CHECK HELPER (Retained) ---
-    def _check_class_conflict(self, block_date_dt, block_start_min, block_end_min, classes):
+    def _check_class_conflict(self, block_date_dt, block_start_min, block_end_min, classes_by_day):
         """
         Checks if the proposed study block conflicts with any user's fixed classes.
+        classes_by_day maps a day name to that day's classes.
         """
         day_name = DAY_OF_WEEK_MAP.get(block_date_dt.weekday())
 
-        for cls in classes:
-            if cls.get('day') == day_name:
-                class_start_min = _time_to_minutes(cls.get('start_time'))
-                class_end_min = _time_to_minutes(cls.get('end_time'))
+        for cls in classes_by_day.get(day_name, ()):
+            # start_min/end_min are stored at write time; older classes fall back to parsing
+            class_start_min = cls.get('start_min')
+            if class_start_min is None: class_start_min = time_to_minutes(cls.get('start_time'))
+            class_end_min = cls.get('end_min')
+            if class_end_min is None: class_end_min = time_to_minutes(cls.get('end_time'))
 
-                if _check_overlap(block_start_min, block_end_min, class_start_min, class_end_min):
-                    return True, cls.get('subject')  # Conflict found
+            if _check_overlap(block_start_min, block_end_min, class_start_min, class_end_min):
+                return True, cls.get('subject')  # Conflict found
         return False, None
 
     # --- STANDARD PLANNER FUNCTIONS ---
@@ -223,7 +240,7 @@ class PlannerEngine:
         Runs the planner for consolidation (retained for generic save_task triggers).
         """
         now_dt = now_dt.astimezone(PH_TZ)
-        user_data = self.db_service.get_user_data(user_id)
+        user_data = self.db_service.get_user_data(user_id, {"generated_plan": 1})
 
         final_plan = user_data.get("generated_plan", [])
 
@@ -241,25 +258,23 @@ class PlannerEngine:
         work_items = []
         all_items = user_data.get("tasks", []) + user_data.get("tests", [])
         for item in all_items:
-            try:
-                deadline_str = item.get("deadline", item.get("date"))
-                if 'T' not in deadline_str: deadline_str += "T23:59:59"
-                deadline = datetime.fromisoformat(deadline_str).replace(tzinfo=PH_TZ)
+            deadline = parse_deadline_fast(item)
+            if deadline is None:
+                print(f"Skipping item due to invalid deadline: {item.get('name')}")
+                continue
 
-                item_type = item.get("task_type", item.get("test_type"))
+            item_type = item.get("task_type", item.get("test_type"))
 
-                work_items.append({
-                    "name": item.get("name"),
-                    "deadline": deadline,
-                    "item_type": item_type
-                })
-            except Exception as e:
-                print(f"Skipping item due to parse error: {item.get('name')}, {e}")
+            work_items.append({
+                "name": item.get("name"),
+                "deadline": deadline,
+                "item_type": item_type
+            })
 
         return work_items
 
     def get_daily_plan(self, user_id):
-        user_data = self.db_service.get_user_data(user_id)
+        user_data = self.db_service.get_user_data(user_id, {"generated_plan": 1})
         generated_plan = user_data.get("generated_plan", [])
 
         today_str = datetime.now(PH_TZ).strftime("%Y-%m-%d")
@@ -0,0 +1,44 @@
+"""
+Pure scheduling helpers shared by the planner and the DB service layer.
+"""
+from datetime import datetime, timedelta, time, timezone
+from functools import lru_cache
+
+# --- CONSTANTS ---
+PH_TZ = timezone(timedelta(hours=8))  # >>> Philippines timezone <<<
+
+
+# --- HELPER FUNCTIONS ---
+def time_to_minutes(time_str):
+    """Converts HH:MM string to minutes since midnight."""
+    try:
+        t = time.fromisoformat(time_str)
+        return t.hour * 60 + t.minute
+    except ValueError:
+        return 0
+
+
+@lru_cache(maxsize=4096)
+def parse_iso_cached(deadline_str, default_tz=PH_TZ):
+    """
+    Parses an ISO deadline string into an aware datetime (naive values get default_tz).
+    Deadlines are stored in canonical form at write time; date-only legacy values
+    still default to end of day. Results are cached since the same deadlines are re-read on every request.
+    """
+    if 'T' not in deadline_str:
+        deadline_str += "T23:59:59"
+    dt = datetime.fromisoformat(deadline_str)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=default_tz)
+    return dt
+
+
+def parse_deadline_fast(item):
+    """Returns the item's aware deadline, or None when it is missing or malformed."""
+    deadline_str = item.get("deadline", item.get("date"))
+    if not isinstance(deadline_str, str):
+        return None
+    try:
+        return parse_iso_cached(deadline_str)
+    except ValueError:
+        return None